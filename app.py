@@ -4,14 +4,49 @@ This application serves a machine learning model for predictions.
 """
 
 import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 import joblib
-import pandas as pd
 import numpy as np
-from flask import Flask, request, jsonify
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from flask import Flask, Response, request, jsonify
+
+# oneDAL's forest must be patched in before sklearn.ensemble is imported
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn('random_forest_classifier', verbose=False)
+    SKLEARNEX_PATCHED = True
+except ImportError:
+    SKLEARNEX_PATCHED = False
+
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, classification_report
 import logging
+
+# GPU training is optional; large datasets use cuML when a GPU is present
+try:
+    from cuml.ensemble import RandomForestClassifier as CumlRandomForest
+    CUML_AVAILABLE = True
+except ImportError:
+    CUML_AVAILABLE = False
+
+# Compiled inference runtime is optional; predictions fall back to sklearn
+try:
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
 from config import get_dataset_config, get_app_config, get_model_config
 
 # Configure logging
@@ -22,84 +57,431 @@ app = Flask(__name__)
 
 # Global variables for model and data
 model = None
+onnx_session = None
+# Bumped whenever a new model is published; part of every cache key
+model_generation = 0
+model_lock = threading.Lock()
 app_config = get_app_config()
 model_path = app_config['model_path']
+onnx_path = app_config['onnx_path']
 data_path = app_config['data_path']
 
+# Dynamic batching: request threads enqueue (features, future) pairs and a
+# single background worker runs the model once per batch
+batch_queue = queue.Queue()
+batch_worker = None
+batch_worker_lock = threading.Lock()
+
+# Retraining runs off the request thread. Job state and the model version
+# live under models/ so every worker process sees the same view
+retrain_executor = ThreadPoolExecutor(max_workers=1)
+model_version_path = app_config['model_version_path']
+retrain_jobs_dir = app_config['retrain_jobs_dir']
+loaded_model_version = None
+last_version_check = 0.0
+reload_lock = threading.Lock()
+
+# Per-thread (1, n_features) float32 input buffers reused across requests
+request_buffers = threading.local()
+
+def forest_predict_proba(forest, X):
+    """Average tree probabilities without sklearn's per-call input checks."""
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    proba = np.zeros((X.shape[0], len(forest.classes_)))
+    for tree in forest.estimators_:
+        proba += tree.predict_proba(X, check_input=False)
+    proba /= len(forest.estimators_)
+    return proba
+
+def predict_proba_batch(current_model, current_session, X):
+    """Return class probabilities for a stacked batch of feature rows."""
+    if current_session is not None:
+        return current_session.run(
+            ['probabilities'], {'X': X.astype(np.float32)}
+        )[0]
+    # oneDAL forests predict natively; only walk stock sklearn trees by hand
+    if (isinstance(current_model, RandomForestClassifier)
+            and not SKLEARNEX_PATCHED):
+        return forest_predict_proba(current_model, X)
+    return current_model.predict_proba(X)
+
+def warm_up_model():
+    """Run one prediction so the first request does not pay cold-start cost."""
+    if model is None:
+        return
+    
+    X = np.zeros((1, model.n_features_in_), dtype=np.float32)
+    predict_proba_batch(model, onnx_session, X)
+
+def collect_batch():
+    """Block for one request, then gather more until the batch is full or
+    the batch timeout expires."""
+    max_batch_size = app_config['max_batch_size']
+    batch = [batch_queue.get()]
+    deadline = time.monotonic() + app_config['batch_timeout_ms'] / 1000.0
+    while len(batch) < max_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(batch_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def run_batch_worker():
+    """Drain the batch queue and run one model call per batch."""
+    while True:
+        batch = collect_batch()
+
+        current_model = model
+        current_session = onnx_session
+        try:
+            if current_model is None:
+                raise RuntimeError('Model not loaded')
+            X = np.vstack([features for features, _ in batch])
+            # One forest traversal: derive the class from predict_proba
+            proba = predict_proba_batch(current_model, current_session, X)
+            best = proba.argmax(axis=1)
+            predictions = current_model.classes_[best]
+            # ONNX Runtime sums tree votes in float32; round every backend to
+            # the ~6 digits float32 can represent and clip so it stays <= 1
+            probabilities = np.clip(
+                np.round(proba[np.arange(len(batch)), best].astype(np.float64),
+                         6),
+                0, 1
+            )
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            continue
+
+        for (_, future), prediction, probability in zip(
+            batch, predictions, probabilities
+        ):
+            future.set_result((prediction, probability))
+
+def start_batch_worker():
+    """Start the batch worker thread if it is not already running."""
+    global batch_worker
+
+    with batch_worker_lock:
+        if batch_worker is None or not batch_worker.is_alive():
+            batch_worker = threading.Thread(
+                target=run_batch_worker, name='batch-worker', daemon=True
+            )
+            batch_worker.start()
+
+def write_atomically(path, write):
+    """Write ``path`` through a temp file and rename it into place.
+    
+    Workers loading or reloading the file never see it half written; they get
+    either the old or the new version.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp'
+    )
+    os.close(fd)
+    try:
+        os.chmod(tmp_path, 0o644)
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_bytes(data):
+    """Return a writer for ``write_atomically`` that stores raw bytes."""
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return write
+
+def export_onnx_model(trained_model):
+    """Convert a fitted forest to ONNX and return an inference session."""
+    if not ONNX_AVAILABLE:
+        return None
+    
+    try:
+        onnx_model = convert_sklearn(
+            trained_model,
+            initial_types=[
+                ('X', FloatTensorType([None, trained_model.n_features_in_]))
+            ],
+            options={id(trained_model): {'zipmap': False}}
+        )
+        write_atomically(
+            onnx_path, write_bytes(onnx_model.SerializeToString())
+        )
+        return load_onnx_session()
+    except Exception as e:
+        logger.warning("ONNX export failed, using the native model: %s", str(e))
+        discard_onnx_model()
+        return None
+
+def discard_onnx_model():
+    """Remove a saved ONNX model so it is not paired with a newer pickle."""
+    if os.path.exists(onnx_path):
+        os.remove(onnx_path)
+
+def load_onnx_session():
+    """Load the ONNX inference session if the runtime and model exist."""
+    if not ONNX_AVAILABLE or not os.path.exists(onnx_path):
+        return None
+    
+    try:
+        # One thread per session: parallelism comes from the gunicorn workers,
+        # so a per-session pool would oversubscribe the cores
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        session = ort.InferenceSession(
+            onnx_path, sess_options=options, providers=['CPUExecutionProvider']
+        )
+        logger.info("ONNX session loaded from %s", onnx_path)
+        return session
+    except Exception as e:
+        logger.warning("Error loading ONNX model, using sklearn: %s", str(e))
+        return None
+
+def quantize_features(values, n_features):
+    """Copy a feature list into this thread's buffer and return its cache key."""
+    if not isinstance(values, list) or len(values) != n_features:
+        raise ValueError(f'Expected {n_features} features')
+    
+    buffer = getattr(request_buffers, 'features', None)
+    if buffer is None or buffer.shape[1] != n_features:
+        buffer = np.empty((1, n_features), dtype=np.float32)
+        request_buffers.features = buffer
+    
+    # Overflow becomes inf here and is rejected just below
+    with np.errstate(over='ignore', invalid='ignore'):
+        buffer[0, :] = values
+    # sklearn's input checks are bypassed, so reject null (NaN) and overflow
+    if not np.isfinite(buffer).all():
+        raise ValueError('Features must be finite numbers')
+    np.round(buffer, app_config['prediction_cache_decimals'], out=buffer)
+    return buffer.tobytes()
+
+@lru_cache(maxsize=app_config['prediction_cache_size'])
+def predict_cached(features_key, generation):
+    """Predict one quantized feature row, memoizing repeated inputs.
+    
+    ``generation`` is the model generation the caller observed, so a result
+    computed while a retrain is swapping models is never served afterwards.
+    """
+    features = np.frombuffer(features_key, dtype=np.float32).reshape(1, -1)
+    start_batch_worker()
+    future = Future()
+    batch_queue.put((features, future))
+    return future.result(timeout=app_config['predict_timeout_ms'] / 1000.0)
+
+def publish_model(new_model, new_session, version):
+    """Swap in a model and its ONNX session and start a new cache generation."""
+    global model, onnx_session, model_generation, loaded_model_version
+    
+    with model_lock:
+        model, onnx_session = new_model, new_session
+        model_generation += 1
+        loaded_model_version = version
+    
+    # Entries for earlier generations can never be hit again
+    predict_cached.cache_clear()
+
+def read_model_version():
+    """Return the version stamp of the saved model, or None if unset."""
+    try:
+        with open(model_version_path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def load_saved_model():
+    """Load model.pkl and its ONNX session from disk and publish them."""
+    # Read the stamp first; a newer save in between just triggers a reload
+    version = read_model_version()
+    loaded_model = joblib.load(model_path)
+    # Batches are tiny, so joblib dispatch would cost more than it saves
+    if isinstance(loaded_model, RandomForestClassifier):
+        loaded_model.n_jobs = 1
+    logger.info("Model loaded successfully from %s", model_path)
+    publish_model(loaded_model, load_onnx_session(), version)
+
+def reload_model_if_stale():
+    """Reload the model when another worker has saved a newer version."""
+    global last_version_check
+    
+    now = time.monotonic()
+    if now - last_version_check < app_config['model_check_interval_ms'] / 1000.0:
+        return
+    if not reload_lock.acquire(blocking=False):
+        return
+    
+    try:
+        last_version_check = now
+        version = read_model_version()
+        if version is None or version == loaded_model_version:
+            return
+        logger.info("Model version changed to %s, reloading", version)
+        try:
+            load_saved_model()
+        except Exception as e:
+            # Keep serving the current model rather than dropping it
+            logger.error("Error reloading model: %s", str(e))
+    finally:
+        reload_lock.release()
+
 def load_or_create_model():
     """Load existing model or create a new one if it doesn't exist."""
-    global model
-    
     if os.path.exists(model_path):
         try:
-            model = joblib.load(model_path)
-            logger.info("Model loaded successfully from %s", model_path)
+            load_saved_model()
         except Exception as e:
             logger.error("Error loading model: %s", str(e))
-            model = None
+            publish_model(None, None, None)
     else:
         logger.info("No existing model found. Creating new model...")
         create_and_train_model()
 
-def create_and_train_model():
-    """Create and train a new model with sample data."""
-    global model
-    
-    try:
-        # Get group-specific dataset configuration
-        dataset_config = get_dataset_config()
-        model_config = get_model_config()
-        
-        # Create sample dataset (unique for each group)
-        np.random.seed(dataset_config['random_seed'])
-        n_samples = dataset_config['n_samples']
-        n_features = dataset_config['n_features']
-        
-        # Generate synthetic data
-        X = np.random.randn(n_samples, n_features)
-        # Create target variable based on features
-        y = (np.sum(X, axis=1) > 0).astype(int)
-        
-        # Add noise to make it more realistic
-        noise = np.random.normal(0, dataset_config['noise_level'], n_samples)
-        y = (np.sum(X, axis=1) + noise > 0).astype(int)
-        
-        # Split the data
-        X_train, X_test, y_train, y_test = train_test_split(
-            X, y, test_size=0.2, random_state=dataset_config['random_seed']
-        )
-        
-        # Train the model
-        model = RandomForestClassifier(
-            n_estimators=model_config['n_estimators'],
+    warm_up_model()
+    start_batch_worker()
+
+def build_forest(n_estimators, model_config, use_gpu=False):
+    """Create an unfitted forest from the model configuration."""
+    if use_gpu:
+        # cuML predicts through its GPU forest inference (FIL) backend
+        return CumlRandomForest(
+            n_estimators=n_estimators,
             random_state=model_config['random_state'],
             max_depth=model_config['max_depth'],
             min_samples_split=model_config['min_samples_split'],
             min_samples_leaf=model_config['min_samples_leaf']
         )
-        model.fit(X_train, y_train)
-        
-        # Evaluate the model
-        y_pred = model.predict(X_test)
-        accuracy = accuracy_score(y_test, y_pred)
-        
-        logger.info("Model trained successfully. Accuracy: %.4f", accuracy)
-        
-        # Save the model
-        os.makedirs(os.path.dirname(model_path), exist_ok=True)
-        joblib.dump(model, model_path)
-        
-        # Save the dataset
-        os.makedirs(os.path.dirname(data_path), exist_ok=True)
-        df = pd.DataFrame(X, columns=[f'feature_{i}' for i in range(n_features)])
-        df['target'] = y
-        df.to_csv(data_path, index=False)
+    
+    return RandomForestClassifier(
+        n_estimators=n_estimators,
+        random_state=model_config['random_state'],
+        max_depth=model_config['max_depth'],
+        min_samples_split=model_config['min_samples_split'],
+        min_samples_leaf=model_config['min_samples_leaf'],
+        n_jobs=model_config['n_jobs']
+    )
+
+def select_n_estimators(X, y, model_config, use_gpu=False):
+    """Return the smallest tree count within tolerance of the best accuracy."""
+    X_fit, X_val, y_fit, y_val = train_test_split(
+        X, y, test_size=model_config['validation_size'],
+        random_state=model_config['random_state']
+    )
+    
+    scores = {}
+    for n_estimators in sorted(model_config['n_estimators_grid']):
+        forest = build_forest(n_estimators, model_config, use_gpu)
+        forest.fit(X_fit, y_fit)
+        scores[n_estimators] = accuracy_score(y_val, forest.predict(X_val))
+    
+    best = max(scores.values())
+    return min(
+        n for n, score in scores.items()
+        if score >= best - model_config['n_estimators_tolerance']
+    )
+
+def create_and_train_model(allow_gpu=True):
+    """Create and train a new model with sample data.
+    
+    Pass ``allow_gpu=False`` in processes that fork afterwards (the gunicorn
+    master), since a CUDA context does not survive fork.
+    """
+    # Get group-specific dataset configuration
+    dataset_config = get_dataset_config()
+    model_config = get_model_config()
+    
+    # Create sample dataset (unique for each group)
+    rng = np.random.default_rng(dataset_config['random_seed'])
+    n_samples = dataset_config['n_samples']
+    n_features = dataset_config['n_features']
+    
+    # Generate synthetic data
+    X = rng.standard_normal((n_samples, n_features), dtype=np.float32)
+    
+    # Target is the sign of the feature sum plus noise, built in one buffer
+    score = X.sum(axis=1, dtype=np.float32)
+    score += (
+        rng.standard_normal(n_samples, dtype=np.float32)
+        * dataset_config['noise_level']
+    )
+    y = (score > 0).view(np.int8)
+    
+    # Split the data
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=0.2, random_state=dataset_config['random_seed']
+    )
+    
+    # Offload to the GPU only when the dataset is large enough to pay off
+    use_gpu = (allow_gpu and CUML_AVAILABLE
+               and n_samples >= model_config['gpu_min_samples'])
+    if use_gpu:
+        y_train = y_train.astype(np.int32)
+    
+    # Pick the smallest forest that keeps validation accuracy
+    model_config['n_estimators'] = select_n_estimators(
+        X_train, y_train, model_config, use_gpu
+    )
+    
+    # Train the model; predictions keep using the old one until it is saved
+    new_model = build_forest(model_config['n_estimators'], model_config, use_gpu)
+    new_model.fit(X_train, y_train)
+    if not use_gpu:
+        # Trees are fit in parallel, but serving batches stay single-threaded
+        new_model.n_jobs = 1
+    
+    # Evaluate the model
+    y_pred = new_model.predict(X_test)
+    accuracy = accuracy_score(y_test, y_pred)
+    
+    logger.info("Model trained successfully with %d trees. Accuracy: %.4f",
+                new_model.n_estimators, accuracy)
+    
+    columns = {f'feature_{i}': X[:, i] for i in range(n_features)}
+    columns['target'] = y
+    
+    # Only the file IO is expected to fail; a trained model is served anyway
+    try:
+        # Other workers may be reloading model.pkl; never expose a partial file
+        write_atomically(model_path, lambda path: joblib.dump(new_model, path))
+        write_atomically(
+            data_path, lambda path: pacsv.write_csv(pa.table(columns), path)
+        )
         
         logger.info("Model and dataset saved successfully")
-        
     except Exception as e:
-        logger.error("Error creating model: %s", str(e))
-        model = None
+        logger.error("Error saving model: %s", str(e))
+        # Leave the files on disk consistent; only this worker gets the model
+        publish_model(new_model, None, read_model_version())
+        return
+    
+    if use_gpu:
+        new_session = None
+        discard_onnx_model()
+    else:
+        new_session = export_onnx_model(new_model)
+    
+    # Stamp last, once model.pkl and model.onnx are both in place, so other
+    # workers reload a consistent pair
+    version = uuid.uuid4().hex
+    write_atomically(model_version_path, write_bytes(version.encode()))
+    publish_model(new_model, new_session, version)
+
+def json_response(payload, status=200):
+    """Serialize a payload (numpy scalars included) with orjson."""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype='application/json'
+    )
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -109,38 +491,59 @@ def health_check():
         'message': 'MLOps CI/CD Pipeline Application is running'
     })
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    """Prediction endpoint."""
+def predict_from_body(body):
+    """Run a raw /predict request body through the model.
+    
+    Shared by the Flask route and the ASGI route in asgi.py; returns the
+    response payload and HTTP status code.
+    """
     try:
+        reload_model_if_stale()
         if model is None:
-            return jsonify({'error': 'Model not loaded'}), 500
+            return {'error': 'Model not loaded'}, 500
         
         # Get input data
-        data = request.get_json()
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return {'error': 'Invalid JSON'}, 400
         
-        if not data or 'features' not in data:
-            return jsonify({'error': 'No features provided'}), 400
+        if not isinstance(data, dict) or 'features' not in data:
+            return {'error': 'No features provided'}, 400
         
-        features = np.array(data['features']).reshape(1, -1)
+        # Reject malformed rows up front so they cannot fail a whole batch
+        try:
+            features_key = quantize_features(
+                data['features'], model.n_features_in_
+            )
+        except (TypeError, ValueError) as e:
+            return {'error': str(e)}, 400
         
-        # Make prediction
-        prediction = model.predict(features)[0]
-        probability = model.predict_proba(features)[0]
+        # Make prediction through the cache and batching worker
+        prediction, probability = predict_cached(
+            features_key, model_generation
+        )
         
-        return jsonify({
-            'prediction': int(prediction),
-            'probability': float(max(probability)),
+        return {
+            'prediction': prediction,
+            'probability': probability,
             'features': data['features']
-        })
+        }, 200
         
     except Exception as e:
         logger.error("Prediction error: %s", str(e))
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    """Prediction endpoint."""
+    payload, status = predict_from_body(request.get_data())
+    return json_response(payload, status)
 
 @app.route('/model/info', methods=['GET'])
 def model_info():
     """Get model information."""
+    reload_model_if_stale()
     if model is None:
         return jsonify({'error': 'Model not loaded'}), 500
     
@@ -150,16 +553,72 @@ def model_info():
         'n_estimators': model.n_estimators if hasattr(model, 'n_estimators') else 'Unknown'
     })
 
+def job_status_path(job_id):
+    """Return the status file path for a retraining job."""
+    return os.path.join(retrain_jobs_dir, f'{job_id}.json')
+
+def write_job_status(job_id, status, **fields):
+    """Record a retraining job's state where every worker can read it."""
+    payload = dict(fields, job_id=job_id, status=status)
+    write_atomically(job_status_path(job_id), write_bytes(orjson.dumps(payload)))
+
+def prune_retrain_jobs():
+    """Drop the oldest job status files beyond the configured limit."""
+    if not os.path.isdir(retrain_jobs_dir):
+        return
+    
+    paths = [
+        os.path.join(retrain_jobs_dir, name)
+        for name in os.listdir(retrain_jobs_dir) if name.endswith('.json')
+    ]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:-app_config['retrain_jobs_max']]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def run_retrain_job(job_id):
+    """Train a new model and record the outcome in the job's status file."""
+    try:
+        create_and_train_model()
+    except Exception as e:
+        # Only the message is kept, not the traceback and its training frames
+        logger.error("Retraining error: %s", str(e))
+        write_job_status(job_id, 'failed', error=str(e))
+        return
+    
+    write_job_status(
+        job_id, 'completed', message='Model retrained successfully'
+    )
+
 @app.route('/retrain', methods=['POST'])
 def retrain_model():
-    """Retrain the model endpoint."""
+    """Start retraining in the background and return the job id."""
     try:
-        create_and_train_model()
-        return jsonify({'message': 'Model retrained successfully'})
+        job_id = uuid.uuid4().hex
+        write_job_status(job_id, 'running')
+        prune_retrain_jobs()
+        retrain_executor.submit(run_retrain_job, job_id)
+        return jsonify({
+            'message': 'Model retraining started',
+            'job_id': job_id
+        }), 202
     except Exception as e:
         logger.error("Retraining error: %s", str(e))
         return jsonify({'error': str(e)}), 500
 
+@app.route('/retrain/status/<job_id>', methods=['GET'])
+def retrain_status(job_id):
+    """Report the state of a retraining job."""
+    try:
+        # Only accept ids we could have issued; keeps lookups inside the dir
+        job_id = uuid.UUID(job_id).hex
+        with open(job_status_path(job_id), 'rb') as f:
+            return jsonify(orjson.loads(f.read()))
+    except (ValueError, FileNotFoundError):
+        return jsonify({'error': 'Unknown job id'}), 404
+
 if __name__ == '__main__':
     # Load or create model on startup
     load_or_create_model()
@@ -0,0 +1,46 @@
+"""
+ASGI entry point for MLOps CI/CD Pipeline
+Serves /predict as a native Starlette route and mounts the Flask
+application for every other endpoint.
+
+uvicorn has no master-side bootstrap like gunicorn_conf.on_starting, so
+with several workers build the model once before starting the server:
+
+    python -c "from app import load_or_create_model; load_or_create_model()"
+    uvicorn asgi:app --workers N --loop uvloop --http httptools
+"""
+
+from contextlib import asynccontextmanager
+import orjson
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from app import app as flask_app, load_or_create_model, predict_from_body
+
+async def predict_asgi(request):
+    """Prediction endpoint without Flask's request handling."""
+    body = await request.body()
+    # The batcher blocks on a Future, so keep it off the event loop
+    payload, status = await run_in_threadpool(predict_from_body, body)
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status_code=status,
+        media_type='application/json'
+    )
+
+@asynccontextmanager
+async def lifespan(app):
+    """Load the model and start the batch worker in each server process."""
+    # Only trains if models/ is empty; pre-build it when running many workers
+    load_or_create_model()
+    yield
+
+app = Starlette(
+    routes=[
+        Route('/predict', predict_asgi, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    lifespan=lifespan
+)
@@ -44,17 +44,32 @@ APP_CONFIG = {
     'port': int(os.environ.get('PORT', 5000)),
     'debug': os.environ.get('FLASK_ENV') == 'development',
     'model_path': 'models/model.pkl',
-    'data_path': 'data/dataset.csv'
+    'onnx_path': 'models/model.onnx',
+    'model_version_path': 'models/model.version',
+    'model_check_interval_ms': 1000,
+    'retrain_jobs_dir': 'models/retrain_jobs',
+    'retrain_jobs_max': 50,
+    'data_path': 'data/dataset.csv',
+    'max_batch_size': 32,
+    'batch_timeout_ms': 2,
+    'predict_timeout_ms': 5000,
+    'prediction_cache_size': 4096,
+    'prediction_cache_decimals': 4
 }
 
 # Model Configuration
 MODEL_CONFIG = {
     'algorithm': 'RandomForestClassifier',
-    'n_estimators': 100,
+    'n_estimators': 20,
+    'n_estimators_grid': [10, 20, 50, 100],
+    'n_estimators_tolerance': 0.005,
+    'validation_size': 0.2,
     'random_state': 42,
     'max_depth': 10,
     'min_samples_split': 2,
-    'min_samples_leaf': 1
+    'min_samples_leaf': 1,
+    'n_jobs': -1,
+    'gpu_min_samples': 100000
 }
 
 # CI/CD Configuration
@@ -65,18 +80,24 @@ CICD_CONFIG = {
     'max_line_length': 88
 }
 
+# Resolved configuration (GROUP_ID is fixed at import time)
+DATASET = DATASET_CONFIG.get(GROUP_ID, DATASET_CONFIG['group_1'])
+APP = APP_CONFIG
+MODEL = MODEL_CONFIG
+CICD = CICD_CONFIG
+
 def get_dataset_config():
     """Get dataset configuration for the current group."""
-    return DATASET_CONFIG.get(GROUP_ID, DATASET_CONFIG['group_1'])
+    return DATASET
 
 def get_app_config():
     """Get application configuration."""
-    return APP_CONFIG
+    return APP
 
 def get_model_config():
     """Get model configuration."""
-    return MODEL_CONFIG
+    return MODEL
 
 def get_cicd_config():
     """Get CI/CD configuration."""
-    return CICD_CONFIG
+    return CICD
@@ -0,0 +1,31 @@
+"""
+Gunicorn configuration for MLOps CI/CD Pipeline
+Runs the Flask application with threaded workers so concurrent /predict
+requests can be batched by each worker's batch queue.
+"""
+
+import os
+from config import get_app_config
+
+app_config = get_app_config()
+
+bind = f"{app_config['host']}:{app_config['port']}"
+workers = int(os.environ.get('GUNICORN_WORKERS', os.cpu_count() or 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = 'gthread'
+timeout = 120
+
+def on_starting(server):
+    """Train the model once in the master so workers do not race to create it."""
+    from app import model_path, create_and_train_model
+
+    # CUDA does not survive fork, so the master always trains on the CPU;
+    # later /retrain jobs run in the workers and may use the GPU
+    if not os.path.exists(model_path):
+        create_and_train_model(allow_gpu=False)
+
+def post_fork(server, worker):
+    """Load the model and start the batch worker thread in each worker."""
+    from app import load_or_create_model
+
+    load_or_create_model()
@@ -7,7 +7,13 @@ import json
 import os
 import tempfile
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+import app as app_module
 from app import app, model, create_and_train_model
+from config import get_model_config
 
 @pytest.fixture
 def client():
@@ -24,6 +30,23 @@ def client():
         with app.test_client() as client:
             yield client
 
+def wait_for_job(client, job_id, timeout=60):
+    """Poll a retraining job's status until it leaves the running state."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        data = json.loads(client.get(f'/retrain/status/{job_id}').data)
+        if data['status'] != 'running':
+            return data
+        time.sleep(0.05)
+    raise AssertionError(f'Retraining job {job_id} did not finish')
+
+def retrain_and_wait(client):
+    """Start a retraining job and block until it finishes."""
+    response = client.post('/retrain')
+    job_id = json.loads(response.data)['job_id']
+    wait_for_job(client, job_id)
+    return job_id
+
 @pytest.fixture
 def sample_features():
     """Sample features for testing."""
@@ -71,12 +94,90 @@ def test_predict_invalid_input(client):
 def test_retrain_model(client):
     """Test model retraining endpoint."""
     response = client.post('/retrain')
-    assert response.status_code == 200
+    assert response.status_code == 202
     
     data = json.loads(response.data)
-    assert 'message' in data
+    assert 'job_id' in data
+    
+    data = wait_for_job(client, data['job_id'])
+    assert data['status'] == 'completed'
     assert 'retrained successfully' in data['message']
 
+def test_retrain_failure_is_reported(client, monkeypatch):
+    """Test a training error surfaces as a failed retraining job."""
+    def broken_forest(*args, **kwargs):
+        raise RuntimeError('training failed')
+    
+    monkeypatch.setattr(app_module, 'build_forest', broken_forest)
+    
+    response = client.post('/retrain')
+    data = wait_for_job(client, json.loads(response.data)['job_id'])
+    assert data['status'] == 'failed'
+    assert 'training failed' in data['error']
+
+def test_retrain_status_unknown_job(client):
+    """Test status lookup for a job id that was never issued."""
+    response = client.get('/retrain/status/does-not-exist')
+    assert response.status_code == 404
+    
+    data = json.loads(response.data)
+    assert 'error' in data
+
+def test_retrain_status_is_shared_across_workers(client):
+    """Test a job's status is readable without the in-process job handle."""
+    job_id = retrain_and_wait(client)
+    
+    # Another worker only has the files under models/ to go on
+    path = app_module.job_status_path(job_id)
+    with open(path) as f:
+        assert json.load(f)['status'] == 'completed'
+
+def test_retrain_jobs_are_capped(client, monkeypatch):
+    """Test old job status files are pruned beyond the configured limit."""
+    monkeypatch.setitem(app_module.app_config, 'retrain_jobs_max', 2)
+    for _ in range(3):
+        retrain_and_wait(client)
+    
+    assert len(os.listdir(app_module.retrain_jobs_dir)) <= 2
+
+def test_model_reloads_when_version_changes(client, monkeypatch):
+    """Test a worker reloads the model another worker saved."""
+    retrain_and_wait(client)
+    current_model = app_module.model
+    
+    # Simulate another worker publishing a new model version
+    app_module.write_atomically(app_module.model_version_path,
+                                app_module.write_bytes(b'other-worker'))
+    monkeypatch.setattr(app_module, 'last_version_check', 0.0)
+    
+    response = client.post('/predict',
+                           json={'features': [0.5, -0.3, 0.8, -0.1]})
+    assert response.status_code == 200
+    assert app_module.model is not current_model
+    assert app_module.loaded_model_version == 'other-worker'
+
+def test_gpu_training_branch(client, monkeypatch):
+    """Test the cuML training path, with sklearn standing in for cuML."""
+    retrain_and_wait(client)
+    assert os.path.exists(app_module.onnx_path)
+    
+    monkeypatch.setattr(app_module, 'CUML_AVAILABLE', True)
+    monkeypatch.setattr(app_module, 'CumlRandomForest',
+                        RandomForestClassifier, raising=False)
+    monkeypatch.setitem(app_module.get_model_config(), 'gpu_min_samples', 0)
+    
+    retrain_and_wait(client)
+    assert app_module.onnx_session is None
+    assert not os.path.exists(app_module.onnx_path)
+    
+    response = client.post('/predict',
+                           json={'features': [0.5, -0.3, 0.8, -0.1]})
+    assert response.status_code == 200
+    
+    # A process that forks afterwards never trains on the GPU
+    app_module.create_and_train_model(allow_gpu=False)
+    assert app_module.onnx_session is not None
+
 def test_model_creation():
     """Test model creation and training function."""
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -96,10 +197,30 @@ def test_model_creation():
         loaded_model = joblib.load(model_path)
         assert loaded_model is not None
 
+@pytest.mark.parametrize('accuracy_20, expected', [
+    (0.946, 20),   # within 0.5% of the best (0.95): smallest qualifying size
+    (0.944, 50),   # just outside tolerance: falls through to the next size
+])
+def test_select_n_estimators_applies_tolerance(monkeypatch, accuracy_20,
+                                               expected):
+    """Test tree-count selection keeps the smallest size within tolerance."""
+    # Validation accuracy per size, in the order the sorted grid is fit
+    accuracies = iter([0.90, accuracy_20, 0.95, 0.949])
+    monkeypatch.setattr(app_module, 'accuracy_score',
+                        lambda y_true, y_pred: next(accuracies))
+    
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((200, 4), dtype=np.float32)
+    y = (X.sum(axis=1) > 0).astype(int)
+    
+    config = dict(get_model_config(), n_estimators_grid=[100, 10, 50, 20],
+                  n_estimators_tolerance=0.005, n_jobs=1)
+    assert app_module.select_n_estimators(X, y, config) == expected
+
 def test_predict_with_valid_model(client):
     """Test prediction with a valid model."""
     # First retrain to ensure we have a model
-    client.post('/retrain')
+    retrain_and_wait(client)
     
     # Test prediction
     response = client.post('/predict', 
@@ -113,10 +234,172 @@ def test_predict_with_valid_model(client):
     assert isinstance(data['prediction'], int)
     assert isinstance(data['probability'], float)
 
+def test_predict_wrong_feature_count(client):
+    """Test prediction rejects rows with the wrong number of features."""
+    retrain_and_wait(client)
+    
+    response = client.post('/predict', json={'features': [0.5, -0.3]})
+    assert response.status_code == 400
+    
+    data = json.loads(response.data)
+    assert 'error' in data
+    
+    response = client.post('/predict',
+                           json={'features': ['a', 'b', 'c', 'd']})
+    assert response.status_code == 400
+
+def test_predict_non_finite_features(client):
+    """Test null and overflowing feature values are rejected."""
+    retrain_and_wait(client)
+    
+    response = client.post('/predict', json={'features': [None, 1, 2, 3]})
+    assert response.status_code == 400
+    
+    response = client.post('/predict', data='{"features": [1e300, 1, 2, 3]}',
+                           content_type='application/json')
+    assert response.status_code == 400
+    assert 'finite' in json.loads(response.data)['error']
+
+def test_predict_invalid_json_with_model(client):
+    """Test malformed JSON bodies are rejected once a model is loaded."""
+    retrain_and_wait(client)
+    
+    response = client.post('/predict', data='invalid json',
+                           content_type='application/json')
+    assert response.status_code == 400
+    assert response.content_type == 'application/json'
+    
+    data = json.loads(response.data)
+    assert 'error' in data
+
+def test_predict_concurrent_requests_are_batched(monkeypatch):
+    """Test concurrent predictions are served in shared model calls."""
+    app.config['TESTING'] = True
+    retrain_and_wait(app.test_client())
+    
+    batch_sizes = []
+    original_predict_proba_batch = app_module.predict_proba_batch
+    
+    def recording_predict_proba_batch(current_model, current_session, X):
+        batch_sizes.append(X.shape[0])
+        return original_predict_proba_batch(current_model, current_session, X)
+    
+    monkeypatch.setattr(app_module, 'predict_proba_batch',
+                        recording_predict_proba_batch)
+    # A wide window makes batch formation deterministic under test
+    monkeypatch.setitem(app_module.app_config, 'batch_timeout_ms', 200)
+    
+    def post_features(features):
+        with app.test_client() as client:
+            return client.post('/predict', json={'features': features})
+    
+    rows = [[0.1 * i, -0.2, 0.3, -0.1 * i] for i in range(16)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(post_features, rows))
+    
+    for row, response in zip(rows, responses):
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['features'] == row
+        assert data['prediction'] in (0, 1)
+    
+    assert sum(batch_sizes) == len(rows)
+    assert max(batch_sizes) > 1
+
+def test_predict_repeated_features_hit_cache(client):
+    """Test repeated feature vectors are served from the prediction cache."""
+    retrain_and_wait(client)
+    
+    first = client.post('/predict', json={'features': [0.5, -0.3, 0.8, -0.1]})
+    hits_before = app_module.predict_cached.cache_info().hits
+    second = client.post('/predict',
+                         json={'features': [0.50001, -0.3, 0.8, -0.1]})
+    assert app_module.predict_cached.cache_info().hits == hits_before + 1
+    
+    first_data = json.loads(first.data)
+    second_data = json.loads(second.data)
+    assert first_data['prediction'] == second_data['prediction']
+    assert first_data['probability'] == second_data['probability']
+    assert second_data['features'] == [0.50001, -0.3, 0.8, -0.1]
+
+def test_prediction_cache_is_keyed_by_model_generation(client):
+    """Test a result cached for an old model is not served for a new one."""
+    retrain_and_wait(client)
+    generation = app_module.model_generation
+    key = app_module.quantize_features([0.5, -0.3, 0.8, -0.1], 4)
+    
+    # A miss started before the swap stores its result after the cache clear
+    app_module.publish_model(app_module.model, app_module.onnx_session,
+                             app_module.loaded_model_version)
+    app_module.predict_cached(key, generation)
+    misses_before = app_module.predict_cached.cache_info().misses
+    
+    app_module.predict_cached(key, app_module.model_generation)
+    assert app_module.model_generation == generation + 1
+    assert app_module.predict_cached.cache_info().misses == misses_before + 1
+
+def test_onnx_session_matches_sklearn(client):
+    """Test the ONNX session agrees with the sklearn forest."""
+    pytest.importorskip('onnxruntime')
+    
+    retrain_and_wait(client)
+    assert app_module.onnx_session is not None
+    
+    options = app_module.onnx_session.get_session_options()
+    assert options.intra_op_num_threads == 1
+    assert options.inter_op_num_threads == 1
+    
+    X = np.random.RandomState(0).randn(20, 4).astype(np.float32)
+    onnx_proba = app_module.onnx_session.run(['probabilities'], {'X': X})[0]
+    sklearn_proba = app_module.model.predict_proba(X)
+    assert np.allclose(onnx_proba, sklearn_proba, atol=1e-5)
+    
+    # Served probabilities match sklearn and never exceed 1, including rows
+    # where every tree agrees
+    rows = np.vstack([X[:5], np.full((1, 4), 3.0, dtype=np.float32)])
+    expected = app_module.model.predict_proba(rows).max(axis=1)
+    for row, expected_probability in zip(rows, expected):
+        _, probability = app_module.predict_cached(
+            row.tobytes(), app_module.model_generation
+        )
+        assert probability <= 1
+        assert abs(float(probability) - expected_probability) <= 1e-6
+
+def test_forest_predict_proba_matches_sklearn(client):
+    """Test the unchecked tree average matches RandomForest.predict_proba."""
+    retrain_and_wait(client)
+    
+    X = np.random.RandomState(0).randn(20, 4)
+    expected = app_module.model.predict_proba(X)
+    actual = app_module.forest_predict_proba(app_module.model, X)
+    assert np.allclose(actual, expected)
+
+def test_load_model_from_disk(client):
+    """Test a saved model is reloaded from disk and still predicts."""
+    retrain_and_wait(client)
+    app_module.model = None
+    app_module.load_or_create_model()
+    assert app_module.model is not None
+    assert app_module.model.n_jobs == 1
+    
+    response = client.post('/predict',
+                           json={'features': [0.5, -0.3, 0.8, -0.1]})
+    assert response.status_code == 200
+
+def test_retrain_replaces_model_file_atomically(client):
+    """Test retraining renames a new model.pkl into place."""
+    retrain_and_wait(client)
+    inode_before = os.stat(app_module.model_path).st_ino
+    
+    retrain_and_wait(client)
+    assert os.stat(app_module.model_path).st_ino != inode_before
+    assert not [name for name in os.listdir(os.path.dirname(
+        app_module.model_path)) if name.endswith('.tmp')]
+
 def test_model_info_with_model(client):
     """Test model info endpoint with a loaded model."""
     # First retrain to ensure we have a model
-    client.post('/retrain')
+    retrain_and_wait(client)
     
     response = client.get('/model/info')
     assert response.status_code == 200
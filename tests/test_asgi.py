@@ -0,0 +1,39 @@
+"""
+Unit tests for the ASGI entry point
+"""
+
+import pytest
+from starlette.testclient import TestClient
+from asgi import app
+
+@pytest.fixture
+def client():
+    """Create a test client that runs the ASGI startup hooks."""
+    with TestClient(app) as client:
+        yield client
+
+def test_health_check_through_flask_mount(client):
+    """Test non-hot endpoints are still served by the mounted Flask app."""
+    response = client.get('/health')
+    assert response.status_code == 200
+    assert response.json()['status'] == 'healthy'
+
+def test_predict_asgi(client):
+    """Test the native Starlette prediction route."""
+    response = client.post('/predict',
+                           json={'features': [0.5, -0.3, 0.8, -0.1]})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    
+    data = response.json()
+    assert data['prediction'] in (0, 1)
+    assert isinstance(data['probability'], float)
+    assert data['features'] == [0.5, -0.3, 0.8, -0.1]
+
+def test_predict_asgi_invalid_input(client):
+    """Test the Starlette prediction route rejects bad input."""
+    response = client.post('/predict', content='invalid json')
+    assert response.status_code == 400
+    
+    response = client.post('/predict', json={'features': [0.5]})
+    assert response.status_code == 400